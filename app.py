@@ -3,17 +3,16 @@ from streamlit_mic_recorder import mic_recorder
 import traceback
 import time
 import tempfile
-import io
 import os
 import hashlib
-from pydub import AudioSegment
 from youtube_search import fetch_metadata_and_download, search_youtube
-from audio_processing import trim_audio, process_audio, extract_vocals, convert_to_midi, is_in_library
+from audio_processing import PREVIEW_SAMPLE_RATE, load_audio_clip, process_audio, extract_vocals, convert_to_midi, is_in_library
 from utils import setup_logger, display_results, process_and_add_to_library
-from download_utils import download_button
 from consts import SAMPLE_QUERIES_DIR, LIBRARY_DIR, MIDIS_DIR, METADATA_DIR, LOG_DIR
 import consts
 import subprocess
+import threading
+from midi_chunk_processor import load_library
 
 # Set page configuration to hide the sidebar by default
 st.set_page_config(
@@ -31,8 +30,16 @@ consts.DEBUG = debug_option
 # Ensure all required directories exist
 required_dirs = [LIBRARY_DIR, MIDIS_DIR, METADATA_DIR, LOG_DIR]
 for dir_path in required_dirs:
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
+
+@st.cache_resource
+def warm_library_cache():
+    """Start loading the reference library in the background, once per server process."""
+    thread = threading.Thread(target=load_library, args=(MIDIS_DIR,), daemon=True)
+    thread.start()
+    return thread
+
+warm_library_cache()
 
 def search_songs(query, songs):
     return [song for song in songs if query.lower() in song.lower()]
@@ -41,8 +48,9 @@ def search_songs(query, songs):
 library_songs = [os.path.splitext(f)[0] for f in os.listdir(MIDIS_DIR) if f.endswith('.mid')]
 
 def get_sorted_files_by_mod_time(directory):
-    # Get the list of files and their modification times
-    files = [(file, os.path.getmtime(os.path.join(directory, file))) for file in os.listdir(directory)]
+    # Get the list of files and their modification times in a single directory scan
+    with os.scandir(directory) as entries:
+        files = [(entry.name, entry.stat().st_mtime) for entry in entries if entry.is_file()]
     # Sort files by modification time (latest to earliest)
     sorted_files = sorted(files, key=lambda x: x[1], reverse=True)
     # Extract just the filenames
@@ -77,13 +85,9 @@ def main():
 
             st.write(f"Processing sample query: {selected_query}")
             try:
-                audio = AudioSegment.from_file(query_path)
-                audio = trim_audio(audio)  # Trim to 20 seconds
-                
-                # Convert the audio to a format Streamlit can play
-                buffer = io.BytesIO()
-                audio.export(buffer, format="wav")
-                st.audio(buffer.getvalue(), format="audio/wav")
+                # Decode only the first 20 seconds for playback
+                audio = load_audio_clip(query_path)
+                st.audio(audio, sample_rate=PREVIEW_SAMPLE_RATE)
                 
                 # Process the audio
                 top_matches, query_midi_path = process_audio(query_path)
@@ -108,18 +112,11 @@ def main():
 
         # If audio data is available, save it and play it back
         if audio:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp_file:
-                tmp_file.write(audio['bytes'])
-                tmp_file_path = tmp_file.name
-
-            # Convert webm to wav using pydub
-            #audio_segment = AudioSegment.from_file(tmp_file_path, format="webm")
-
-            subprocess.run(["ffmpeg", "-i", tmp_file_path, tmp_file_path.replace('.webm', '.wav')], check=True)
-            audio_segment = AudioSegment.from_file(tmp_file_path.replace('.webm', '.wav'), format="wav")
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
+                wav_tmp_file_path = tmp_file.name
 
-            wav_tmp_file_path = tmp_file_path.replace(".webm", ".wav")
-            audio_segment.export(wav_tmp_file_path, format="wav")
+            # Convert the recorded webm to wav, feeding ffmpeg the bytes directly
+            subprocess.run(["ffmpeg", "-y", "-i", "pipe:0", wav_tmp_file_path], input=audio['bytes'], check=True)
 
             st.audio(wav_tmp_file_path, format="audio/wav")
 
@@ -146,13 +143,9 @@ def main():
             # Now load the audio from the temporary file
             try:
                 start_time = time.time()
-                audio = AudioSegment.from_file(tmp_file_path)
-                audio = trim_audio(audio)  # Trim to 20 seconds
-                
-                # Convert the audio to a format Streamlit can play
-                buffer = io.BytesIO()
-                audio.export(buffer, format="wav")
-                st.audio(buffer.getvalue(), format="audio/wav")
+                # Decode only the first 20 seconds for playback
+                audio = load_audio_clip(tmp_file_path)
+                st.audio(audio, sample_rate=PREVIEW_SAMPLE_RATE)
                 
                 st.write(f"Processed audio in {time.time() - start_time:.2f} seconds.")
 
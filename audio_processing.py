@@ -2,12 +2,12 @@ import subprocess
 import traceback
 import logging
 import tempfile
-from pydub import AudioSegment
+import io
+import numpy as np
 import os
 import hashlib
 import re
-from download_utils import download_button
-from midi_chunk_processor import best_matches, midi_to_pitches_and_times, load_chunks_from_directory
+from midi_chunk_processor import midi_to_pitches_and_times, library_matches
 from mido import MidiFile, MidiTrack, Message
 import mido
 import streamlit as st
@@ -39,48 +39,61 @@ def convert_to_midi(audio_file, midi_file):
     env = os.environ.copy()
     env.pop('PYTHONPATH', None)
 
-    print(f"Running command: {' '.join(cmd)}")  # Debugging line
+    logging.debug("Running command: %s", ' '.join(cmd))
     subprocess.run(cmd, check=True, env=env)
     #subprocess.run(cmd, check=True)
 
-def trim_audio(audio_segment, duration_ms=20000):
-    """Trim the audio to the specified duration in milliseconds."""
-    return audio_segment[:duration_ms]
+PREVIEW_SAMPLE_RATE = 22050
+
+def load_audio_clip(audio_file_path, duration=20, sample_rate=PREVIEW_SAMPLE_RATE):
+    """Decode only the first `duration` seconds of the audio file to mono int16 PCM."""
+    cmd = [
+        "ffmpeg", "-v", "quiet",
+        "-i", audio_file_path,
+        "-t", str(duration),
+        "-ac", "1",
+        "-ar", str(sample_rate),
+        "-f", "s16le", "pipe:1"
+    ]
+    result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
+    return np.frombuffer(result.stdout, dtype=np.int16)
 
 def process_audio(audio_file_path):
-    if not os.path.exists(MIDIS_DIR):
-        os.makedirs(MIDIS_DIR)
+    os.makedirs(MIDIS_DIR, exist_ok=True)
 
     with tempfile.NamedTemporaryFile(delete=False, suffix=".mid") as temp_midi:
         midi_file_path = temp_midi.name
 
     try:
         convert_to_midi(audio_file_path, midi_file_path)
-        st.success("Audio converted to MIDI successfully!")
-        download_str = download_button(open(midi_file_path, "rb").read(), "query.mid", "Download Query MIDI")
-        st.markdown(download_str, unsafe_allow_html=True)
-
-        # Load the query MIDI file
-        query_pitches, query_times = midi_to_pitches_and_times(midi_file_path)
-        
-        # Load reference MIDI files
-        result = load_chunks_from_directory(MIDIS_DIR)
-        all_chunks, all_start_times, track_names = load_chunks_from_directory(MIDIS_DIR)
-
-        st.info("Finding the best matches...")
-
-        # Find best matches
-        top_n = 5
-        if consts.DEBUG:
-            top_n = 30
-        top_matches = best_matches(query_pitches, all_chunks, all_start_times, track_names=track_names, top_n=top_n)
-
-        return top_matches, midi_file_path
+        with open(midi_file_path, "rb") as f:
+            query_midi = f.read()
+
+        # Parse the query MIDI from the bytes already in memory
+        query_pitches, query_times = midi_to_pitches_and_times(io.BytesIO(query_midi))
     except Exception as e:
-        print(traceback.format_exc())
-        print(f"Error processing audio file: {e}")
+        logging.error("Error processing audio file: %s\n%s", e, traceback.format_exc())
         return None, None
 
+    # Widgets stay outside the try blocks; the key is per query so results shown in two tabs in one rerun don't collide
+    st.success("Audio converted to MIDI successfully!")
+    st.download_button("Download Query MIDI", query_midi, file_name="query.mid", mime="audio/midi", on_click="ignore",
+                       key=f"query_download_{os.path.basename(midi_file_path)}")
+
+    st.info("Finding the best matches...")
+
+    # Find best matches against the library (repeat queries reuse the previous result until the library changes)
+    top_n = 5
+    if consts.DEBUG:
+        top_n = 30
+    try:
+        top_matches = library_matches(query_pitches, MIDIS_DIR, top_n=top_n)
+    except Exception as e:
+        logging.error("Error processing audio file: %s\n%s", e, traceback.format_exc())
+        return None, None
+
+    return top_matches, midi_file_path
+
 def extract_vocals(mp3_file, output_dir):
     cmd = [
         "demucs",
@@ -94,76 +107,54 @@ def is_in_library(query):
     midi_file = os.path.join(MIDIS_DIR, f"{query_hash}.mid")
     return os.path.exists(midi_file)
 
-def split_midi(pitches, times, chunk_length=20, overlap=10):
-    chunks = []
-    start_times = []
-    
-    num_chunks = (len(times) - overlap) // (chunk_length - overlap)
-    
-    for i in range(num_chunks):
-        start_idx = i * (chunk_length - overlap)
-        end_idx = start_idx + chunk_length
-        
-        chunk_pitches = pitches[start_idx:end_idx]
-        chunk_times = times[start_idx:end_idx]
-        
-        chunks.append((chunk_pitches, chunk_times))
-        start_times.append(times[start_idx])
-        
-    return chunks, start_times
-
 def extract_midi_chunk(midi_file_path, start_time, duration=20):
     try:
         midi = MidiFile(midi_file_path)
-        chunk = MidiFile()
-        for i, track in enumerate(midi.tracks):
-            new_track = MidiTrack()
-            current_time = 0
-            for msg in track:
-                current_time += msg.time
-                if start_time <= current_time <= start_time + duration:
-                    new_track.append(msg)
-            chunk.tracks.append(new_track)
-        return chunk
-    except Exception as e:
-        print(f"Error extracting MIDI chunk: {e}")
-        return None
-
-def extract_midi_chunk(midi_file_path, start_time, duration=20):
-    try:
-        midi = MidiFile(midi_file_path)
-        chunk = MidiFile()
 
         # Get the ticks per beat from the MIDI file
         ticks_per_beat = midi.ticks_per_beat
+        chunk = MidiFile(ticks_per_beat=ticks_per_beat)
 
+        # Tempo map shared by all tracks: tick of each tempo change, seconds elapsed at that tick and the new tempo.
         # Default tempo is 500000 microseconds per beat if not specified
-        tempo = 500000
-
-        for i, track in enumerate(midi.tracks):
-            new_track = MidiTrack()
-            current_time = 0
-            for msg in track:
-                if msg.type == 'set_tempo':
-                    tempo = msg.tempo
-
-                # Convert ticks to seconds
-                time_in_seconds = mido.tick2second(msg.time, ticks_per_beat, tempo)
-                current_time += time_in_seconds
-
-                if start_time <= current_time <= start_time + duration:
-                    new_track.append(msg)
-
-            chunk.tracks.append(new_track)
+        track_ticks = [np.cumsum(np.fromiter((msg.time for msg in track), dtype=np.int64, count=len(track))) for track in midi.tracks]
+        tempo_changes = sorted(((int(ticks[i]), msg.tempo) for track, ticks in zip(midi.tracks, track_ticks)
+                                for i, msg in enumerate(track) if msg.type == 'set_tempo'), key=lambda change: change[0])
+        tempo_ticks, tempo_seconds, tempos = [0], [0.0], [500000]
+        for tick, tempo in tempo_changes:
+            tempo_seconds.append(tempo_seconds[-1] + mido.tick2second(tick - tempo_ticks[-1], ticks_per_beat, tempos[-1]))
+            tempo_ticks.append(tick)
+            tempos.append(tempo)
+        tempo_ticks, tempo_seconds, tempos = np.array(tempo_ticks), np.array(tempo_seconds), np.array(tempos)
+
+        for track, ticks in zip(midi.tracks, track_ticks):
+            # Convert each message's absolute tick to seconds through the tempo segment it falls in
+            segment = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+            seconds = tempo_seconds[segment] + (ticks - tempo_ticks[segment]) * tempos[segment] / (ticks_per_beat * 1e6)
+
+            in_range = np.flatnonzero((seconds >= start_time) & (seconds <= start_time + duration))
+            chunk.tracks.append(MidiTrack([track[i] for i in in_range.tolist()]))
         return chunk
     except Exception as e:
-        print(f"Error extracting MIDI chunk: {e}")
+        logging.error("Error extracting MIDI chunk: %s", e)
         return None
 
-def save_midi_chunk(chunk, output_path):
-    try:
-        chunk.save(output_path)
-    except Exception as e:
-        print(f"Error saving MIDI chunk: {e}")
+def midi_chunk_bytes(chunk):
+    """Serialize a MIDI chunk in memory, e.g. for a download button."""
+    buffer = io.BytesIO()
+    chunk.save(file=buffer)
+    return buffer.getvalue()
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def _midi_chunk_download(midi_file_path, start_time, mtime_ns):
+    chunk = extract_midi_chunk(midi_file_path, start_time)
+    return midi_chunk_bytes(chunk) if chunk else None
 
+def midi_chunk_download(midi_file_path, start_time):
+    """Serialized MIDI chunk for a result, memoized on the file's mtime so reruns skip the re-extraction."""
+    try:
+        mtime_ns = os.stat(midi_file_path).st_mtime_ns
+    except OSError as e:
+        logging.error("Error extracting MIDI chunk: %s", e)
+        return None
+    return _midi_chunk_download(midi_file_path, start_time, mtime_ns)
@@ -1,9 +1,12 @@
-import streamlit as st
-SAMPLE_QUERIES_DIR = "/home/ubuntu/MeloDetective/data/sample_queries"
-LIBRARY_DIR = "/home/ubuntu/MeloDetective/data/library"
-MIDIS_DIR = "/home/ubuntu/MeloDetective/data/midis"
-METADATA_DIR = "/home/ubuntu/MeloDetective/data/metadata"
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+
+SAMPLE_QUERIES_DIR = os.path.join(DATA_DIR, "sample_queries")
+LIBRARY_DIR = os.path.join(DATA_DIR, "library")
+MIDIS_DIR = os.path.join(DATA_DIR, "midis")
+METADATA_DIR = os.path.join(DATA_DIR, "metadata")
 LOG_DIR = "logs"
-CHUNKS_DIR = "/home/ubuntu/MeloDetective/data/chunks"
 
 DEBUG = False
@@ -1,6 +1,7 @@
 import os
 import subprocess
 import multiprocessing
+import concurrent.futures
 
 # Directory containing the MP3 files
 directory = "SongDetector//home/ubuntu/MeloDetective/data/library"
@@ -8,13 +9,19 @@ directory = "SongDetector//home/ubuntu/MeloDetective/data/library"
 # Get the number of CPU cores
 num_cores = multiprocessing.cpu_count()
 
-# Iterate over the files in the directory
-for filename in os.listdir(directory):
-    if filename.endswith(".mp3"):
-        # Construct the full file path
-        file_path = os.path.join(directory, filename)
+# Run several Demucs processes at once, splitting the cores between them
+num_workers = max(1, num_cores // 4)
+jobs_per_worker = max(1, num_cores // num_workers)
 
-        # Run the Demucs command for each file
-        command = f"python3 -m demucs --two-stems=vocals -d cpu -j {num_cores} \"{file_path}\""
-        subprocess.run(command, shell=True)
+def extract_vocals(file_paths):
+    # One Demucs process per batch, so the model is loaded once for all of its files
+    command = ["python3", "-m", "demucs", "--two-stems=vocals", "-d", "cpu", "-j", str(jobs_per_worker)] + file_paths
+    subprocess.run(command)
 
+# Collect the MP3 files in the directory
+file_paths = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith(".mp3")]
+
+batches = [file_paths[i::num_workers] for i in range(num_workers) if file_paths[i::num_workers]]
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    list(executor.map(extract_vocals, batches))
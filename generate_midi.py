@@ -4,13 +4,16 @@ import torchyin
 import mido
 from mido import MidiFile, MidiTrack, Message
 from scipy.ndimage import median_filter
-import pandas as pd
 import numpy as np
+import logging
+from functools import lru_cache
 
 # Constants
 F_MIN = 50  # Minimum frequency (Hz)
 F_MAX = 400  # Maximum frequency (Hz)
 FRAME_LENGTH = 2048  # Frame length
+FRAME_STRIDE = 0.01  # Seconds between pitch estimates
+YIN_SAMPLE_RATE = 22050  # Audio is downsampled to this rate before pitch estimation; Nyquist stays far above F_MAX
 SMOOTHING_WINDOW_SIZE = 50  # Window size for smoothing
 MIN_NOTE_LENGTH = 10  # Minimum length of a note to be considered significant
 REPLACEMENT_WINDOW_SIZE = 30  # Window size for averaging short notes
@@ -18,87 +21,106 @@ REPLACEMENT_WINDOW_SIZE = 30  # Window size for averaging short notes
 def smooth_pitches(pitches, window_size):
     return median_filter(pitches, size=window_size)
 
+def fill_nans_nearest(values):
+    """Replace NaNs with the nearest valid value, taking the earlier one on ties."""
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) == 0:
+        return values
+    positions = np.arange(len(values))
+    right = np.minimum(np.searchsorted(valid, positions), len(valid) - 1)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(positions - valid[left] <= valid[right] - positions, valid[left], valid[right])
+    return values[nearest]
+
+def run_lengths(values):
+    """Start index and length of every run of equal consecutive values."""
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    lengths = np.diff(np.append(starts, len(values)))
+    return starts, lengths
+
 def replace_short_notes(pitches, min_note_length, window_size):
-    smoothed_pitches = []
-    current_note = None
-    note_length = 0
-    note_start = 0
-
-    for i, pitch in enumerate(pitches):
-        if np.isnan(pitch):
-            continue
-
-        note = int(np.round(pitch))
-
-        if current_note is None:
-            current_note = note
-            note_length = 1
-            note_start = i
-        elif note == current_note:
-            note_length += 1
-        else:
-            if note_length < min_note_length:
-                avg_note = int(np.round(np.nanmedian(pitches[max(0, note_start-window_size//2):min(len(pitches), note_start+note_length+window_size//2)])))
-                smoothed_pitches.extend([avg_note] * note_length)
-            else:
-                smoothed_pitches.extend([current_note] * note_length)
-            current_note = note
-            note_length = 1
-            note_start = i
-
-    # Ensure the last note sequence is added
-    if note_length < min_note_length:
-        avg_note = int(np.round(np.nanmedian(pitches[max(0, note_start-window_size//2):min(len(pitches), note_start+note_length+window_size//2)])))
-        smoothed_pitches.extend([avg_note] * note_length)
-    else:
-        smoothed_pitches.extend([current_note] * note_length)
-
-    return smoothed_pitches
+    pitches = np.asarray(pitches, dtype=np.float64)
 
-def remove_short_notes(pitches, min_note_length):
-    cleaned_pitches = []
-    current_note = None
-    note_length = 0
-
-    for pitch in pitches:
-        if current_note is None:
-            current_note = pitch
-            note_length = 1
-        elif pitch == current_note:
-            note_length += 1
-        else:
-            if note_length >= min_note_length:
-                cleaned_pitches.extend([current_note] * note_length)
-            current_note = pitch
-            note_length = 1
-
-    if note_length >= min_note_length:
-        cleaned_pitches.extend([current_note] * note_length)
-
-    return cleaned_pitches
+    # NaN frames are skipped, so runs are taken over the valid frames only
+    valid = np.flatnonzero(~np.isnan(pitches))
+    notes = np.rint(pitches[valid]).astype(np.int64)
+    starts, lengths = run_lengths(notes)
+    run_notes = notes[starts]
 
-def generate_midi(input_file, output_file):
-    # Load the audio file
-    waveform, sample_rate = torchaudio.load(input_file)
+    # Replace each short run with the median pitch around it
+    for run in np.flatnonzero(lengths < min_note_length):
+        note_start, note_length = valid[starts[run]], lengths[run]
+        region = pitches[max(0, note_start-window_size//2):min(len(pitches), note_start+note_length+window_size//2)]
+        run_notes[run] = int(np.round(np.nanmedian(region)))
 
-    # Move the waveform to the GPU
-    waveform = waveform.to('cuda')
+    return np.repeat(run_notes, lengths)
 
-    # Perform pitch estimation using torch-yin
-    pitch = torchyin.estimate(waveform, sample_rate=sample_rate, pitch_min=F_MIN, pitch_max=F_MAX).cpu()[0]
+def remove_short_notes(pitches, min_note_length):
+    pitches = np.asarray(pitches)
+    starts, lengths = run_lengths(pitches)
+    keep = lengths >= min_note_length
+    return np.repeat(pitches[starts[keep]], lengths[keep])
+
+def yin_frame_count(num_samples, sample_rate):
+    """Number of pitch frames torchyin.estimate returns for num_samples samples (two longest periods per frame, padded to at least one frame)."""
+    frame_length = 2 * int(sample_rate / F_MIN)
+    frame_stride = int(FRAME_STRIDE * sample_rate)
+    return (max(num_samples, frame_length) - frame_length) // frame_stride + 1
+
+@lru_cache(maxsize=None)
+def yin_frame_count_matches(sample_rate):
+    """Whether yin_frame_count agrees with torchyin's own output lengths, probed on a few short silent signals."""
+    frame_length = 2 * int(sample_rate / F_MIN)
+    frame_stride = int(FRAME_STRIDE * sample_rate)
+    for num_samples in (frame_length // 2, frame_length, frame_length + 3 * frame_stride + 1):
+        pitch = torchyin.estimate(torch.zeros(1, num_samples), sample_rate=sample_rate, pitch_min=F_MIN, pitch_max=F_MAX, frame_stride=FRAME_STRIDE)
+        if pitch.shape[-1] != yin_frame_count(num_samples, sample_rate):
+            return False
+    return True
+
+def estimate_pitches(waveforms, sample_rate):
+    """torchyin pitch tracks for several mono waveforms, estimated in one zero-padded batch on the GPU."""
+    if len(waveforms) > 1 and not yin_frame_count_matches(sample_rate):
+        # torchyin frames audio differently than yin_frame_count assumes, so the padded batch can't be trimmed safely
+        logging.warning("torchyin framing changed; estimating pitches one file at a time")
+        return [estimate_pitches([waveform], sample_rate)[0] for waveform in waveforms]
+    batch = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True).to('cuda')
+    pitch = torchyin.estimate(batch, sample_rate=sample_rate, pitch_min=F_MIN, pitch_max=F_MAX, frame_stride=FRAME_STRIDE).cpu()
+    if len(waveforms) == 1:
+        return [pitch[0]]
+    # Frames only look at their own samples, so trimming the padding's frames leaves each track as if estimated alone
+    return [track[:yin_frame_count(len(waveform), sample_rate)] for track, waveform in zip(pitch, waveforms)]
+
+def generate_midis(jobs):
+    """generate_midi for several (input_file, output_file) pairs, batching the pitch estimation of files that share a sample rate."""
+    by_sample_rate = {}
+    for input_file, output_file in jobs:
+        waveform, sample_rate = torchaudio.load(input_file)
+        waveform = waveform[0]
+        if sample_rate > YIN_SAMPLE_RATE:
+            waveform = torchaudio.functional.resample(waveform, sample_rate, YIN_SAMPLE_RATE)
+            sample_rate = YIN_SAMPLE_RATE
+        by_sample_rate.setdefault(sample_rate, []).append((waveform, output_file))
+
+    for sample_rate, items in by_sample_rate.items():
+        waveforms = [waveform for waveform, _ in items]
+        for pitch, (waveform, output_file) in zip(estimate_pitches(waveforms, sample_rate), items):
+            pitches_to_midi(pitch, len(waveform) / sample_rate, output_file)
 
-    # Convert to MIDI pitches (0-127)
-    pitches = 69 + 12 * torch.log2(pitch / 440.0)
+def generate_midi(input_file, output_file):
+    generate_midis([(input_file, output_file)])
 
-    # Handle inf values by replacing them with NaN
-    pitches[pitches == float('inf')] = float('nan')
-    pitches[pitches == float('-inf')] = float('nan')
+def pitches_to_midi(pitch, audio_duration, output_file):
+    # Convert to MIDI pitches (0-127); unvoiced frames (pitch 0, log2 of -inf) become NaN
+    pitches = torch.where(pitch > 0, 69 + 12 * torch.log2(pitch / 440.0), float('nan'))
 
     # Smooth the pitch sequence
     smoothed_pitches = smooth_pitches(pitches.numpy(), SMOOTHING_WINDOW_SIZE)
 
-    # Replace NaNs with the nearest valid value using pandas
-    smoothed_pitches = pd.Series(smoothed_pitches).interpolate(method='nearest').fillna(method='bfill').fillna(method='ffill').values
+    # Replace NaNs with the nearest valid value
+    smoothed_pitches = fill_nans_nearest(smoothed_pitches)
 
     # Replace short notes with the median pitch in their region
     cleaned_pitches = replace_short_notes(smoothed_pitches, MIN_NOTE_LENGTH, REPLACEMENT_WINDOW_SIZE)
@@ -106,9 +128,6 @@ def generate_midi(input_file, output_file):
     # Remove any remaining short notes
     final_pitches = remove_short_notes(cleaned_pitches, MIN_NOTE_LENGTH)
 
-    # Calculate the original audio duration in seconds
-    audio_duration = waveform.shape[1] / sample_rate
-
     # Create a new MIDI file and track
     mid = MidiFile()
     track = MidiTrack()
@@ -122,30 +141,15 @@ def generate_midi(input_file, output_file):
     microseconds_per_beat = (audio_duration * 1e6) / (len(final_pitches) / ticks_per_beat)
     track.append(mido.MetaMessage('set_tempo', tempo=int(microseconds_per_beat)))
 
-    # Add MIDI note messages with timing information
-    prev_note = None
-    prev_time = 0
-
-    for i, note in enumerate(final_pitches):
-        if prev_note is not None and note != prev_note:
-            # Add note off message for the previous note
-            track.append(Message('note_off', note=int(prev_note), velocity=64, time=(i - prev_time)))
-            prev_time = i
-        
-        # Add note on message
-        if prev_note is None or note != prev_note:
-            track.append(Message('note_on', note=int(note), velocity=64, time=0))
-        
-        prev_note = note
-
-    # Add final note off message if there is a previous note
-    if prev_note is not None:
-        track.append(Message('note_off', note=int(prev_note), velocity=64, time=(len(final_pitches) - prev_time)))
+    # One note_on/note_off pair per run of equal pitches, each note lasting its run length in ticks
+    starts, lengths = run_lengths(final_pitches)
+    for note, length in zip(final_pitches[starts].tolist(), lengths.tolist()):
+        track.append(Message('note_on', note=int(note), velocity=64, time=0))
+        track.append(Message('note_off', note=int(note), velocity=64, time=length))
 
     # Save the MIDI file
     mid.save(output_file)
     print(f"MIDI file saved to {output_file}")
 
 if __name__ == "__main__":
-    generate_midi('query.mp3', 'query.mid')
-    generate_midi('reference.mp3', 'reference.mid')
+    generate_midis([('query.mp3', 'query.mid'), ('reference.mp3', 'reference.mid')])
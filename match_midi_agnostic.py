@@ -1,36 +1,90 @@
 import mido
 import streamlit as st
 import numpy as np
-from scipy.spatial.distance import cosine
-from multiprocessing import Pool, cpu_count
-import multiprocessing
-from functools import partial
+from functools import partial, lru_cache
+import os
 import logging
 import time
 import traceback
-from fastdtw import fastdtw
 import consts
 import concurrent.futures
+from numba import njit
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 def midi_to_pitches_and_times(midi_file):
-    midi = mido.MidiFile(midi_file)
-    pitches = []
-    times = []
-    time = 0
-    for msg in midi:
-        time += msg.time
-        if msg.type == 'note_on' and msg.velocity > 0:
-            pitches.append(msg.note)
-            times.append(time)
-    return np.array(pitches), np.array(times)
+    """Onset pitches (int8) and times in seconds. midi_file is a path or a binary file object."""
+    if isinstance(midi_file, (str, os.PathLike)):
+        midi = mido.MidiFile(midi_file)
+    else:
+        midi = mido.MidiFile(file=midi_file)
+    messages = mido.merge_tracks(midi.tracks, skip_checks=True)
+
+    # One pass over the messages, looking at each type once
+    onsets, tempo_changes = [], []
+    for i, msg in enumerate(messages):
+        msg_type = msg.type
+        if msg_type == 'note_on':
+            if msg.velocity > 0:
+                onsets.append(i)
+        elif msg_type == 'set_tempo':
+            tempo_changes.append((i, msg.tempo))
+
+    # Absolute time of every message: cumulative ticks, each scaled by the tempo in effect before it
+    delta_ticks = np.fromiter((msg.time for msg in messages), dtype=np.float64, count=len(messages))
+    tempos = np.full(len(messages), 500000.0)
+    for i, tempo in tempo_changes:
+        tempos[i + 1:] = tempo
+    seconds = np.cumsum(delta_ticks * tempos) / (midi.ticks_per_beat * 1e6)
+
+    pitches = np.fromiter((messages[i].note for i in onsets), dtype=np.int8, count=len(onsets))
+    return pitches, seconds[onsets]
+
+NPZ_CACHE_VERSION = 1
+
+def _midi_to_pitches_and_times_npz(midi_file, mtime_ns, size):
+    # Reuse the .npz sidecar if it was written for this exact version of the MIDI file, otherwise parse and rewrite it
+    cache_path = f"{midi_file}.npz"
+    source = np.array([NPZ_CACHE_VERSION, mtime_ns, size], dtype=np.int64)
+    try:
+        with np.load(cache_path) as cached:
+            if 'source' in cached.files and np.array_equal(cached['source'], source):
+                return cached['pitches'], cached['times']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning("Ignoring unreadable cache %s: %s", cache_path, e)
+
+    pitches, times = midi_to_pitches_and_times(midi_file)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, source=source, pitches=pitches, times=times)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning("Could not write %s: %s", cache_path, e)
+    return pitches, times
+
+@lru_cache(maxsize=4096)
+def _midi_to_pitches_and_times_stat(midi_file, mtime_ns, size):
+    pitches, times = _midi_to_pitches_and_times_npz(midi_file, mtime_ns, size)
+    # Cached arrays are shared between callers
+    pitches.flags.writeable = False
+    times.flags.writeable = False
+    return pitches, times
+
+def midi_to_pitches_and_times_cached(midi_file):
+    """midi_to_pitches_and_times memoized on the file's path, mtime and size, in memory and in a .npz next to the file."""
+    stat = os.stat(midi_file)
+    return _midi_to_pitches_and_times_stat(midi_file, stat.st_mtime_ns, stat.st_size)
 
 def split_midi(pitches, times, chunk_length, overlap):
     chunks = []
     start_times = []
+    if len(times) == 0:
+        return chunks, start_times
     num_chunks = int((times[-1] - chunk_length) // (chunk_length - overlap)) + 1
     for i in range(num_chunks):
         start_time = i * (chunk_length - overlap)
@@ -41,27 +95,99 @@ def split_midi(pitches, times, chunk_length, overlap):
         start_times.append(start_time)
     return chunks, start_times
 
-def normalize_pitch_sequence(pitches, shift=0):
-    median_pitch = np.median(pitches)
+def median(values):
+    """np.median, taken for integer arrays from a two-point partition without np.median's per-call overhead."""
+    values = np.asarray(values)
+    n = len(values)
+    if n == 0 or values.dtype.kind not in 'iu':
+        return np.median(values)
+    lower, upper = (n - 1) // 2, n // 2
+    partitioned = np.partition(values, (lower, upper))
+    return (float(partitioned[lower]) + float(partitioned[upper])) / 2
+
+def normalize_pitch_sequence(pitches, shift=0, median_pitch=None):
+    if median_pitch is None:
+        median_pitch = median(pitches)
     normalized_pitches = pitches - median_pitch + shift
     return normalized_pitches
 
 def calculate_histogram(pitches, bin_range=(-20, 21)):
-    histogram, _ = np.histogram(pitches, bins=np.arange(bin_range[0], bin_range[1] + 1))
+    # Unit-width bins over [bin_range[0], bin_range[1]], the last one closed like np.histogram's
+    num_bins = bin_range[1] - bin_range[0]
+    pitches = np.asarray(pitches)
+    pitches = pitches[(pitches >= bin_range[0]) & (pitches <= bin_range[1])]
+    bins = np.minimum(np.floor(pitches).astype(np.int64) - bin_range[0], num_bins - 1)
+    histogram = np.bincount(bins, minlength=num_bins)
     return histogram / np.sum(histogram)
 
-def cosine_similarity(hist1, hist2):
-    return 1 - cosine(hist1, hist2)
-
-def cosine_similarity_matrix(query_hist, reference_hists):
-    dot_product = np.dot(reference_hists, query_hist)
-    query_norm = np.linalg.norm(query_hist)
-    reference_norms = np.linalg.norm(reference_hists, axis=1)
-    similarities = dot_product / (query_norm * reference_norms)
-    return similarities
-
-def weighted_dtw(query_pitches, reference_chunk, stretch_penalty=0.2, threshold=5):
-    distance, path = fastdtw(query_pitches, reference_chunk, dist=lambda x, y: (x - y) ** 2)
+def unit_rows(matrix):
+    """Scale each row of a float matrix to unit L2 norm in place; all-zero rows become NaN so their cosine is undefined."""
+    # Row norms straight from einsum, without the squared copy of the matrix np.linalg.norm builds
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, None]
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    matrix[norms[:, 0] == 0] = np.nan
+    return matrix
+
+def cosine_similarity_matrix(query_hist, unit_reference_hists):
+    """Cosine of the query against rows already scaled by unit_rows: one matrix-vector product."""
+    query_norm = np.sqrt(np.dot(query_hist, query_hist))
+    # Match the matrix dtype so np.dot stays in float32 rather than upcasting a float64 copy of the whole matrix
+    return np.dot(unit_reference_hists, (query_hist / query_norm).astype(unit_reference_hists.dtype))
+
+MIN_DTW_BAND = 8  # Short sequences still get some room to warp
+
+# Explicit signature: compiled (or loaded from the on-disk cache) at import rather than on the first query
+@njit('Tuple((float64, int64[:, :]))(float64[::1], float64[::1], int64)', cache=True, nogil=True)
+def banded_dtw_kernel(x, y, band):
+    """Compiled DTW recurrence and backtrack over float64 arrays; returns the distance and the path as an (k, 2) array."""
+    n, m = len(x), len(y)
+    acc = np.full((n + 1, m + 1), np.inf)
+    acc[0, 0] = 0.0
+    for i in range(1, n + 1):
+        xi = x[i - 1]
+        for j in range(max(1, i - band), min(m, i + band) + 1):
+            best = acc[i - 1, j - 1]
+            if acc[i - 1, j] < best:
+                best = acc[i - 1, j]
+            if acc[i, j - 1] < best:
+                best = acc[i, j - 1]
+            diff = xi - y[j - 1]
+            acc[i, j] = diff * diff + best
+
+    # Backtrack from the end cell, preferring diagonal steps on ties
+    path = np.empty((n + m, 2), dtype=np.int64)
+    path[0, 0], path[0, 1] = n - 1, m - 1
+    k = 1
+    i, j = n, m
+    while i > 1 or j > 1:
+        diagonal, up, left = acc[i - 1, j - 1], acc[i - 1, j], acc[i, j - 1]
+        if diagonal <= up and diagonal <= left:
+            i, j = i - 1, j - 1
+        elif up <= left:
+            i -= 1
+        else:
+            j -= 1
+        path[k, 0], path[k, 1] = i - 1, j - 1
+        k += 1
+    return acc[n, m], path[:k][::-1]
+
+def banded_dtw(x, y, window=0.1, min_band=MIN_DTW_BAND):
+    """DTW with squared-difference cost, restricted to a Sakoe-Chiba band of width window * max(len(x), len(y)), at least min_band."""
+    n, m = len(x), len(y)
+    if n == 0 or m == 0:
+        return float('inf'), []
+    if window is None:
+        band = max(n, m)
+    else:
+        # The band must be at least |n - m| wide for the end cell to be reachable
+        band = max(int(window * max(n, m)), min_band, abs(n - m))
+
+    # The kernel releases the GIL, so the reranking threads run it in parallel
+    distance, path = banded_dtw_kernel(np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(y, dtype=np.float64), band)
+    return distance, [tuple(step) for step in path.tolist()]
+
+def weighted_dtw(query_pitches, reference_chunk, stretch_penalty=0.2, threshold=5, window=0.1):
+    distance, path = banded_dtw(query_pitches, reference_chunk, window=window)
     total_distance = distance
     stretch_length = 0
     path_length = len(path)
@@ -87,91 +213,131 @@ def weighted_dtw(query_pitches, reference_chunk, stretch_penalty=0.2, threshold=
             total_distance += (stretch_length ** 2) * stretch_penalty
     return total_distance, path
 
-def process_chunk_cosine(chunk_data, query_hist, semitone_range):
-    try:
-        idx, chunk, start_time, track_name = chunk_data
-        if len(chunk) == 0 or np.isnan(chunk).all():
-            return None
-
-        best_similarity = -1
-        best_shift = 0
-        median_diff_semitones = 0
-
-        for shift in range(*semitone_range):
-            normalized_chunk = normalize_pitch_sequence(chunk, shift)
-            chunk_hist = calculate_histogram(normalized_chunk)
-            similarity = cosine_similarity(query_hist, chunk_hist)
-
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_shift = shift
-                median_diff_semitones = int(np.median(chunk) - np.median(query_hist))
-
-        return (best_similarity, start_time, best_shift, median_diff_semitones, track_name, idx)
-    except Exception as e:
-        logging.error("Error in process_chunk_cosine: %s", traceback.format_exc())
-        return None
-
-def process_chunk_cosine_matrix_batch(query_hist, reference_chunks, chunk_data, start_times, track_names):
-    reference_hists = []
-    for idx, shift in chunk_data:
-        chunk = reference_chunks[idx]
-        if len(chunk) == 0 or np.isnan(chunk).all():
-            continue
-        normalized_chunk = normalize_pitch_sequence(chunk, shift)
-        chunk_hist = calculate_histogram(normalized_chunk)
-        reference_hists.append(chunk_hist)
-    reference_hists = np.array(reference_hists)
-    similarities = cosine_similarity_matrix(query_hist, reference_hists)
-    results = []
-    for ((idx, shift), similarity) in zip(chunk_data, similarities):
-        median_diff_semitones = int(np.median(reference_chunks[idx]) - np.median(query_hist))
-        track_name = track_names[idx]
-        start_time = start_times[idx]
-        results.append((similarity, start_time, shift, median_diff_semitones, track_name, idx))
-    return results
-
-def best_matches_cosine(query_pitches, reference_chunks, start_times, track_names, top_n=100):
+CHUNK_PAD = np.iinfo(np.int8).max
+
+def pack_pitches(pitches, lengths):
+    """Lay out back-to-back chunks of the given lengths as one (num_chunks, max_length) int8 array padded with CHUNK_PAD."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    packed = np.full((len(lengths), lengths.max(initial=0)), CHUNK_PAD, dtype=np.int8)
+    packed[np.arange(packed.shape[1]) < lengths[:, None]] = pitches
+    return packed
+
+def pack_chunks(chunks):
+    """Stack pitch chunks into one (num_chunks, max_length) int8 array padded with CHUNK_PAD, plus the chunk lengths."""
+    lengths = np.fromiter((len(chunk) for chunk in chunks), dtype=np.int64, count=len(chunks))
+    pitches = np.concatenate(chunks) if len(chunks) else np.empty(0, dtype=np.int8)
+    return pack_pitches(pitches, lengths), lengths
+
+def chunk_medians(packed, lengths):
+    """Median pitch of every row of pack_chunks' output (0 for empty chunks), from one row-wise sort."""
+    if packed.shape[1] == 0:
+        return np.zeros(len(packed))
+    # The padding is at least as high as any pitch, so it sorts after each row's notes
+    ordered = np.sort(packed, axis=1)
+    rows = np.arange(len(packed))
+    lower = ordered[rows, np.maximum(lengths - 1, 0) // 2].astype(np.float64)
+    upper = ordered[rows, lengths // 2]
+    return np.where(lengths > 0, (lower + upper) / 2, 0.0)
+
+def packed_histograms(packed, lengths, shifts, bin_range=(-20, 21)):
+    """Histogram of every chunk of a pack_pitches block at every shift as a (num_chunks, num_shifts, num_bins) matrix of unit_rows."""
+    shifts = np.asarray(shifts)
+    num_chunks, num_shifts = len(lengths), len(shifts)
+    num_bins = bin_range[1] - bin_range[0]
+
+    medians = chunk_medians(packed, lengths)
+    pitches = packed[np.arange(packed.shape[1]) < lengths[:, None]]
+    chunk_ids = np.repeat(np.arange(num_chunks), lengths)
+
+    normalized = pitches - medians[chunk_ids]
+    row_offsets = chunk_ids * num_bins
+
+    # One shift at a time, reusing the buffers, so the temporaries hold one value per library pitch rather than one per pitch and shift
+    histograms = np.empty((num_chunks, num_shifts, num_bins), dtype=np.float32)
+    values = np.empty_like(normalized)
+    bins = np.empty(len(normalized), dtype=np.int64)
+    for i, shift in enumerate(shifts):
+        np.add(normalized, shift, out=values)
+        valid = (values >= bin_range[0]) & (values <= bin_range[1])
+        # Unit-width bins, the last one closed like np.histogram's
+        np.floor(values, out=values)
+        np.copyto(bins, values, casting='unsafe')
+        bins -= bin_range[0]
+        np.minimum(bins, num_bins - 1, out=bins)
+        bins += row_offsets
+        histograms[:, i, :] = np.bincount(bins[valid], minlength=num_chunks * num_bins).reshape(num_chunks, num_bins)
+
+    return unit_rows(histograms.reshape(num_chunks * num_shifts, num_bins)).reshape(num_chunks, num_shifts, num_bins)
+
+def reference_histograms(reference_chunks, shifts, bin_range=(-20, 21)):
+    """packed_histograms for a list of pitch chunks."""
+    packed, lengths = pack_chunks(reference_chunks)
+    return packed_histograms(packed, lengths, shifts, bin_range)
+
+COSINE_SHIFTS = np.arange(-2, 3)
+
+def best_matches_cosine(query_pitches, reference_chunks, start_times, track_names, top_n=100, reference_hists=None):
+    """Cosine prefilter; reference_hists is reference_histograms(reference_chunks, COSINE_SHIFTS), computed here if not given."""
     start = time.time()
     normalized_query_pitches = normalize_pitch_sequence(query_pitches)
     query_hist = calculate_histogram(normalized_query_pitches)
 
-    chunk_data = [(idx, shift) for idx in range(len(reference_chunks)) for shift in range(-2, 3)]
-    batch_size = len(chunk_data) // cpu_count()  # Divide work into batches
-    chunk_batches = [chunk_data[i:i + batch_size] for i in range(0, len(chunk_data), batch_size)]
-
-    with Pool(processes=cpu_count()) as pool:
-        results = pool.starmap(process_chunk_cosine_matrix_batch, [(query_hist, reference_chunks, batch, start_times, track_names) for batch in chunk_batches])
+    shifts = COSINE_SHIFTS
+    if reference_hists is None:
+        reference_hists = reference_histograms(reference_chunks, shifts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarities = cosine_similarity_matrix(query_hist, reference_hists.reshape(-1, reference_hists.shape[-1]))
+    # Empty chunks (NaN rows of the unit histograms) rank last; patched in place rather than copied
+    np.nan_to_num(similarities, copy=False, nan=-1.0)
 
     end = time.time()
     if consts.DEBUG:
         st.text("Cosine similarity prefiltering took: %s" % (end - start))
-    # Flatten results
-    results = [item for sublist in results for item in sublist]
-    scores = sorted(results, key=lambda x: x[0], reverse=True)  # Higher similarity is better
 
-    return scores[:top_n]
+    # Select the top_n candidates in linear time and only sort those
+    if top_n < len(similarities):
+        top = np.argpartition(-similarities, top_n)[:top_n]
+    else:
+        top = np.arange(len(similarities))
+    top = top[np.argsort(-similarities[top], kind='stable')]
+
+    query_median = np.median(query_hist)
+    scores = []
+    for flat_idx in top:
+        idx, shift_idx = divmod(int(flat_idx), len(shifts))
+        median_diff_semitones = int(median(reference_chunks[idx]) - query_median)
+        scores.append((similarities[flat_idx], start_times[idx], int(shifts[shift_idx]), median_diff_semitones, track_names[idx], idx))
 
+    return scores
 
-def process_chunk_dtw(chunk_data, query_pitches, reference_chunks):
+
+def normalized_query_shifts(query_pitches, shifts=range(-1, 2), query_median=None):
+    """The median-normalized query at each DTW shift, as (shift, pitches) pairs."""
+    normalized_query = normalize_pitch_sequence(query_pitches, median_pitch=query_median)
+    return [(shift, normalized_query + shift) for shift in shifts]
+
+def process_chunk_dtw(chunk_data, query_pitches, reference_chunks, window=0.1, query_median=None, normalized_queries=None):
+    """DTW rerank of one prefilter candidate; query_median and normalized_queries can be computed once per query and passed in."""
     try:
         cosine_similarity_score, start_time, best_shift, median_diff_semitones, track_name, idx = chunk_data
         chunk = reference_chunks[idx]
         if len(chunk) == 0 or np.isnan(chunk).all():
             return None
 
-        normalized_chunk = normalize_pitch_sequence(chunk, 0)
-        reference_median = np.median(chunk)
+        reference_median = median(chunk)
         if np.isnan(reference_median):
             return None
-        original_median = np.median(query_pitches)
-        median_diff_semitones = int(reference_median - original_median)
+        normalized_chunk = normalize_pitch_sequence(chunk, 0, median_pitch=reference_median)
+        if query_median is None:
+            query_median = median(query_pitches)
+        if normalized_queries is None:
+            normalized_queries = normalized_query_shifts(query_pitches, query_median=query_median)
+        median_diff_semitones = int(reference_median - query_median)
 
         best_score = float('inf')
         best_path = None
-        for shift in range(-1, 2):
-            normalized_query = normalize_pitch_sequence(query_pitches, shift)
-            distance, path = weighted_dtw(normalized_query, normalized_chunk)
+        for shift, normalized_query in normalized_queries:
+            distance, path = weighted_dtw(normalized_query, normalized_chunk, window=window)
             if distance < best_score:
                 best_score = distance
                 best_shift = shift
@@ -182,20 +348,22 @@ def process_chunk_dtw(chunk_data, query_pitches, reference_chunks):
         logging.error("Error in process_chunk_dtw: %s", traceback.format_exc())
         return None
 
-def best_matches(query_pitches, reference_chunks, start_times, track_names, top_n=10):
+def best_matches(query_pitches, reference_chunks, start_times, track_names, top_n=10, window=0.1, reference_hists=None):
     # Step 1: Prefilter with Cosine Similarity
     logging.info("Starting prefiltering with cosine similarity...")
-    top_cosine_matches = best_matches_cosine(query_pitches, reference_chunks, start_times, track_names, top_n=500)
+    top_cosine_matches = best_matches_cosine(query_pitches, reference_chunks, start_times, track_names, top_n=500, reference_hists=reference_hists)
     if consts.DEBUG:
         for i in range(20):
             logging.info(top_cosine_matches[i])
-    mm = [a for a in top_cosine_matches if "ebo" in a[-2]]
-    logging.info("eb matches: %s" % (mm))
+        mm = [a for a in top_cosine_matches if "ebo" in a[-2]]
+        logging.info("eb matches: %s" % (mm))
 
     # Step 2: Rerank with DTW
     logging.info("Starting reranking with DTW...")
     start = time.time()
-    process_chunk_partial = partial(process_chunk_dtw, query_pitches=query_pitches, reference_chunks=reference_chunks)
+    query_median = median(query_pitches)
+    process_chunk_partial = partial(process_chunk_dtw, query_pitches=query_pitches, reference_chunks=reference_chunks, window=window,
+                                    query_median=query_median, normalized_queries=normalized_query_shifts(query_pitches, query_median=query_median))
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
         final_results = list(executor.map(process_chunk_partial, top_cosine_matches))
@@ -207,10 +375,11 @@ def best_matches(query_pitches, reference_chunks, start_times, track_names, top_
     final_scores = [result for result in final_results if result is not None]
     final_scores.sort(key=lambda x: x[1])  # Lower DTW score is better
 
-	# Extract indices and corresponding elements
-    indexed_final_scores = [(index, value) for index, value in enumerate(final_scores)]
-    mm = [(index, value) for index, value in indexed_final_scores if "ebo" in value[-1]]
-    logging.info("eb matches DTW: %s" % (mm))
+    if consts.DEBUG:
+        # Extract indices and corresponding elements
+        indexed_final_scores = [(index, value) for index, value in enumerate(final_scores)]
+        mm = [(index, value) for index, value in indexed_final_scores if "ebo" in value[-1]]
+        logging.info("eb matches DTW: %s" % (mm))
 
     # Ensure unique tracks in final results
     unique_tracks = set()
@@ -1,11 +1,15 @@
 import os
+import struct
 import mido
 import numpy as np
-from match_midi_agnostic import midi_to_pitches_and_times, best_matches, format_time, split_midi
+from match_midi_agnostic import midi_to_pitches_and_times, midi_to_pitches_and_times_cached, best_matches, format_time, split_midi, pack_pitches, packed_histograms, COSINE_SHIFTS
 import streamlit as st
+import consts
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
-from multiprocessing import Pool, cpu_count
+import threading
+from multiprocessing import cpu_count
 
 
 #from generate_midi import generate_midi
@@ -28,52 +32,151 @@ CHUNK_LENGTH = 20  # seconds
 OVERLAP = 18.5  # seconds
 
 MIN_NOTES = 20  # Minimum number of notes in a chunk
-
-def process_midi_file(midi_path, track_name, chunk_length, overlap, min_notes):
-    reference_pitches, reference_times = midi_to_pitches_and_times(midi_path)
+MIN_NOTE_BYTES = 3  # Smallest encoding of a note_on event: 1-byte delta time + note + velocity (running status)
+
+def midi_track_bytes(midi_path):
+    """Total size of the MTrk chunks, read from the chunk headers only. Returns None if the file is not a MIDI file."""
+    try:
+        with open(midi_path, 'rb') as f:
+            chunk_type, header_length, _, num_tracks, _ = struct.unpack(">4sIHHH", f.read(14))
+            if chunk_type != b'MThd':
+                return None
+            f.seek(8 + header_length)
+            total = 0
+            for _ in range(num_tracks):
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_type, length = struct.unpack(">4sI", header)
+                if chunk_type == b'MTrk':
+                    total += length
+                f.seek(length, os.SEEK_CUR)
+            return total
+    except (OSError, struct.error):
+        return None
+
+def process_midi_file(midi_path, chunk_length, overlap, min_notes):
+    """Chunks of one file with at least min_notes notes, as (concatenated pitches, chunk lengths, start times) arrays."""
+    try:
+        reference_pitches, reference_times = midi_to_pitches_and_times_cached(midi_path)
+    except Exception as e:
+        # A corrupt body (e.g. a half-written conversion) drops this file, not the whole library load
+        logging.warning("Skipping unreadable MIDI file %s: %s", midi_path, e)
+        return np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
     chunks, start_times = split_midi(reference_pitches, reference_times, chunk_length, overlap)
 
-    filtered_chunks = []
-    filtered_start_times = []
-    filtered_track_names = []
-
-    for chunk, start_time in zip(chunks, start_times):
-        if len(chunk) >= min_notes:
-            filtered_chunks.append(chunk)
-            filtered_start_times.append(start_time)
-            filtered_track_names.append(track_name)
-
-    return filtered_chunks, filtered_start_times, filtered_track_names
-
-def load_chunks_from_directory(midi_dir):
-    all_chunks = []
+    # A few flat arrays pickle back from the pool workers far cheaper than a list of small arrays
+    keep = [i for i, chunk in enumerate(chunks) if len(chunk) >= min_notes]
+    pitches = np.concatenate([chunks[i] for i in keep]) if keep else np.empty(0, dtype=np.int8)
+    lengths = np.array([len(chunks[i]) for i in keep], dtype=np.int64)
+    return pitches, lengths, np.array([start_times[i] for i in keep], dtype=np.float64)
+
+executor = None
+executor_lock = threading.Lock()
+
+def get_executor():
+    """Process pool for library loading, started on first use and reused by every later load."""
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count())
+        return executor
+
+def map_library_files(process, midi_paths, chunksize=1):
+    """Results of process over midi_paths from the shared pool, rebuilding the pool and retrying once if a worker died."""
+    global executor
+    pool = get_executor()
+    try:
+        return list(pool.map(process, midi_paths, chunksize=chunksize))
+    except BrokenProcessPool:
+        logging.warning("Library worker pool broke, restarting it")
+        with executor_lock:
+            # Another load may already have replaced it
+            if executor is pool:
+                executor = None
+        pool.shutdown(wait=False)
+        return list(get_executor().map(process, midi_paths, chunksize=chunksize))
+
+def _load_packed_chunks(midi_dir):
+    """Library chunks as one pack_pitches block plus their lengths, start times and track names."""
     all_start_times = []
     track_names = []
 
     logging.info("Chunking reference MIDI files...")
 
     midi_files = []
+    skipped = 0
     for root, _, files in os.walk(midi_dir):
         for file in files:
             if file.endswith('.mid'):
                 midi_path = os.path.join(root, file)
+                # Skip files that are malformed or too small to hold a single chunk before fully parsing them
+                track_bytes = midi_track_bytes(midi_path)
+                if track_bytes is None or track_bytes < MIN_NOTES * MIN_NOTE_BYTES:
+                    skipped += 1
+                    continue
                 track_name = os.path.splitext(file)[0]
                 midi_files.append((midi_path, track_name))
+    if skipped:
+        logging.info("Skipped %d malformed or too short MIDI files", skipped)
 
     # Define the partial function for processing each MIDI file
     process_midi_partial = partial(process_midi_file, chunk_length=CHUNK_LENGTH, overlap=OVERLAP, min_notes=MIN_NOTES)
 
-    # Use ThreadPoolExecutor for multithreading
-    #with concurrent.futures.ThreadPoolExecutor() as executor:
-    #    results = list(executor.map(lambda args: process_midi_partial(*args), midi_files))
+    # Use the persistent process pool for parallel processing
+    # Hand each worker several files per task to cut IPC round-trips; map keeps the library order stable
+    midi_paths = [midi_path for midi_path, _ in midi_files]
+    chunksize = max(1, len(midi_files) // (cpu_count() * 4))
+    results = map_library_files(process_midi_partial, midi_paths, chunksize=chunksize)
+
+    all_pitches = []
+    all_lengths = []
+    for (pitches, lengths, start_times), (_, track_name) in zip(results, midi_files):
+        all_pitches.append(pitches)
+        all_lengths.append(lengths)
+        all_start_times.extend(start_times.tolist())
+        track_names.extend([track_name] * len(lengths))
+
+    # Keep the whole library in one contiguous int8 block
+    lengths = np.concatenate(all_lengths) if all_lengths else np.empty(0, dtype=np.int64)
+    pitches = np.concatenate(all_pitches) if all_pitches else np.empty(0, dtype=np.int8)
+    return pack_pitches(pitches, lengths), lengths, all_start_times, track_names
+
+def chunk_views(packed, lengths):
+    """The chunks of a pack_pitches block as a list of row views into it."""
+    return [row[:length] for row, length in zip(packed, lengths.tolist())]
 
-    # Use multiprocessing Pool for parallel processing
-    with Pool(processes=cpu_count()) as pool:
-        results = pool.starmap(process_midi_partial, midi_files)
-
-    for chunks, start_times, track_names_chunk in results:
-        all_chunks.extend(chunks)
-        all_start_times.extend(start_times)
-        track_names.extend(track_names_chunk)
+def load_chunks_from_directory(midi_dir):
+    packed, lengths, all_start_times, track_names = _load_packed_chunks(midi_dir)
+    return chunk_views(packed, lengths), all_start_times, track_names
 
-    return all_chunks, all_start_times, track_names
+def library_signature(midi_dir):
+    """Fingerprint of the .mid files in midi_dir that changes whenever one is added, removed or rewritten."""
+    entries = []
+    for root, _, files in os.walk(midi_dir):
+        for file in files:
+            if file.endswith('.mid'):
+                stat = os.stat(os.path.join(root, file))
+                entries.append((root, file, stat.st_mtime_ns, stat.st_size))
+    return hash(tuple(sorted(entries)))
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _load_library(midi_dir, signature):
+    packed, lengths, all_start_times, track_names = _load_packed_chunks(midi_dir)
+    # The histograms reuse the packed block rather than packing the chunk views a second time
+    reference_hists = packed_histograms(packed, lengths, COSINE_SHIFTS)
+    return chunk_views(packed, lengths), all_start_times, track_names, reference_hists
+
+def load_library(midi_dir):
+    """Chunks, start times, track names and prefilter histograms of the library, kept across Streamlit reruns and sessions until it changes."""
+    return _load_library(midi_dir, library_signature(midi_dir))
+
+# debug is unused in the body but keys the cache: best_matches behaves differently and writes timings to the page under consts.DEBUG
+@st.cache_data(max_entries=128, show_spinner=False)
+def _library_matches(query_pitches, midi_dir, signature, top_n, debug):
+    all_chunks, all_start_times, track_names, reference_hists = _load_library(midi_dir, signature)
+    return best_matches(query_pitches, all_chunks, all_start_times, track_names, top_n=top_n, reference_hists=reference_hists)
+
+def library_matches(query_pitches, midi_dir, top_n=10):
+    """best_matches of the query against the library, memoized on the query's pitches and the library signature."""
+    return _library_matches(np.asarray(query_pitches), midi_dir, library_signature(midi_dir), top_n, consts.DEBUG)
@@ -2,17 +2,16 @@ import os
 import hashlib
 import requests
 import threading
+import concurrent.futures
 import logging
 import subprocess
 import streamlit as st
-from audio_processing import extract_vocals, convert_to_midi, split_midi, midi_to_pitches_and_times, process_audio, sanitize_filename, extract_midi_chunk, save_midi_chunk, is_in_library
+from audio_processing import extract_vocals, convert_to_midi, midi_to_pitches_and_times, process_audio, sanitize_filename, midi_chunk_download, is_in_library
 from youtube_search import fetch_metadata_and_download, search_youtube
-from download_utils import download_button
-from consts import SAMPLE_QUERIES_DIR, LIBRARY_DIR, MIDIS_DIR, METADATA_DIR, LOG_DIR, CHUNKS_DIR 
+from consts import SAMPLE_QUERIES_DIR, LIBRARY_DIR, MIDIS_DIR, METADATA_DIR, LOG_DIR
 import consts
 import numpy as np
 import matplotlib.pyplot as plt
-import tempfile
 import yt_dlp
 
 def setup_logger(name, log_file, level=logging.INFO):
@@ -27,33 +26,34 @@ def setup_logger(name, log_file, level=logging.INFO):
 
 def display_path(path):
     if path:
-        path_x, path_y = zip(*path)
-        plt.figure(figsize=(10, 5))
-        plt.plot(path_x, path_y, 'o-', markersize=2, linewidth=1)
-        plt.xlabel('Query Sequence Index')
-        plt.ylabel('Reference Sequence Index')
-        plt.title('DTW Path')
-        plt.grid(True)
-
-        # Save plot to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmpfile:
-            plt.savefig(tmpfile.name)
-            tmpfile_path = tmpfile.name
-
-        # Display the plot in Streamlit
-        st.image(tmpfile_path)
-        plt.close()
+        # One (k, 2) array instead of unzipping the list of index tuples
+        path = np.asarray(path)
+        fig, ax = plt.subplots(figsize=(10, 5))
+        ax.plot(path[:, 0], path[:, 1], 'o-', markersize=2, linewidth=1)
+        ax.set_xlabel('Query Sequence Index')
+        ax.set_ylabel('Reference Sequence Index')
+        ax.set_title('DTW Path')
+        ax.grid(True)
+
+        # Render the figure straight into the page instead of through a temporary PNG left on disk
+        st.pyplot(fig)
+        plt.close(fig)
 
 def display_results(top_matches, query_midi_path, search_fallback=False):
     st.subheader("Top Matches:")
+    # Download button keys must stay unique when results of several queries are on the page in one rerun
+    query_key = os.path.basename(query_midi_path)
 
     for i, match in enumerate(top_matches):
         cosine_similarity_score, dtw_score, start_time, shift,path, median_diff_semitones, track = match
         query_hash = hashlib.md5(track.encode()).hexdigest()
         metadata_file = os.path.join(METADATA_DIR, f"{query_hash}.txt")
-        if os.path.exists(metadata_file):
+        try:
             with open(metadata_file, 'r') as f:
                 video_url = f.read().strip()
+        except FileNotFoundError:
+            video_url = None
+        if video_url is not None:
             thumbnail_file = os.path.join(METADATA_DIR, f"{query_hash}.jpg")
             youtube_url = f"{video_url}&t={int(start_time)}s"
             st.markdown(f"**Match {i+1}:** [{track}]({youtube_url})")
@@ -61,12 +61,9 @@ def display_results(top_matches, query_midi_path, search_fallback=False):
             st.write(f"Cosine Similarity Score: {cosine_similarity_score:.2f}, DTW Score: {dtw_score:.2f}, Start time: {start_time:.2f}, Shift: {shift} semitones, Median difference: {median_diff_semitones} semitones")
 
             midi_path = os.path.join(MIDIS_DIR, f"{track}.mid")
-            chunk = extract_midi_chunk(midi_path, start_time)
+            chunk = midi_chunk_download(midi_path, start_time)
             if chunk:
-                chunk_path = os.path.join(CHUNKS_DIR, f"{track}_chunk.mid")
-                save_midi_chunk(chunk, chunk_path)
-                midi_download_str = download_button(open(chunk_path, "rb").read(), f"{track}_chunk.mid", "Download Result MIDI Chunk")
-                st.markdown(midi_download_str, unsafe_allow_html=True)
+                st.download_button("Download Result MIDI Chunk", chunk, file_name=f"{track}_chunk.mid", mime="audio/midi", on_click="ignore", key=f"chunk_download_{query_key}_{i}")
             else:
                 st.write(f"No chunk extracted for track: {track}")
         else:
@@ -98,53 +95,62 @@ def display_results(top_matches, query_midi_path, search_fallback=False):
                     st.image(thumbnail_file, width=120)
                     st.write(f"Cosine Similarity Score: {cosine_similarity_score:.2f}, DTW Score: {dtw_score:.2f}, Start time: {start_time:.2f}, Shift: {shift} semitones, Median difference: {median_diff_semitones} semitones")
                     midi_path = os.path.join(MIDIS_DIR, f"{track}.mid")
-                    chunk = extract_midi_chunk(midi_path, start_time)
+                    chunk = midi_chunk_download(midi_path, start_time)
                     if chunk:
-                        chunk_path = os.path.join(CHUNKS_DIR, f"{track}_chunk.mid")
-                        save_midi_chunk(chunk, chunk_path)
-                        midi_download_str = download_button(open(chunk_path, "rb").read(), f"{track}_chunk.mid", "Download Result MIDI Chunk")
-                        st.markdown(midi_download_str, unsafe_allow_html=True)
+                        st.download_button("Download Result MIDI Chunk", chunk, file_name=f"{track}_chunk.mid", mime="audio/midi", on_click="ignore", key=f"chunk_download_{query_key}_{i}")
                 else:
                     st.write(f"No YouTube results found for {track}")
         if consts.DEBUG:
             display_path(path)
 
 def process_and_add_to_library(url):
+    def convert_and_save(video_info, sanitized_video_title, logger):
+        video_title = video_info['title']
+        vocals_path = os.path.join(LIBRARY_DIR, "htdemucs", sanitized_video_title, "vocals.wav")
+        midi_path = os.path.join(MIDIS_DIR, f"{sanitized_video_title}.mid")
+        if os.path.exists(vocals_path):
+            convert_to_midi(vocals_path, midi_path)
+        else:
+            logger.error(f"Vocals file not found for {video_title}")
+        #query_hash = hashlib.md5(video_url.encode()).hexdigest()
+        query_hash = hashlib.md5(sanitized_video_title.encode()).hexdigest()
+        metadata_file = os.path.join(METADATA_DIR, f"{query_hash}.txt")
+        with open(metadata_file, 'w') as f:
+            f.write(video_info['url'])
+        thumbnail_url = video_info.get('thumbnail')
+        if thumbnail_url and thumbnail_url.startswith('http'):
+            thumbnail_file = os.path.join(METADATA_DIR, f"{query_hash}.jpg")
+            response = requests.get(thumbnail_url)
+            with open(thumbnail_file, 'wb') as f:
+                f.write(response.content)
+        else:
+            logger.warning(f"Invalid or missing thumbnail URL for {video_title}")
+        logger.info(f"Completed processing {video_title}")
+
     def background_process(url, logger):
         video_infos = fetch_metadata_and_download(url, LIBRARY_DIR)
-        for video_info in video_infos:
-            if video_info:
-                video_title = video_info['title']
-                video_url = video_info['url']
-                sanitized_video_title = sanitize_filename(video_title)
-                mp3_file = os.path.join(LIBRARY_DIR, f"{sanitized_video_title}.mp3")
-                if not is_in_library(video_url):
-                    logger.info(f"Processing {video_title}...")
-                    extract_vocals(mp3_file, LIBRARY_DIR)
-                    vocals_path = os.path.join(LIBRARY_DIR, "htdemucs", sanitized_video_title, "vocals.wav")
-                    midi_path = os.path.join(MIDIS_DIR, f"{sanitized_video_title}.mid")
-                    if os.path.exists(vocals_path):
-                        convert_to_midi(vocals_path, midi_path)
-                    else:
-                        logger.error(f"Vocals file not found for {video_title}")
-                    #query_hash = hashlib.md5(video_url.encode()).hexdigest()
-                    query_hash = hashlib.md5(sanitized_video_title.encode()).hexdigest()
-                    metadata_file = os.path.join(METADATA_DIR, f"{query_hash}.txt")
-                    with open(metadata_file, 'w') as f:
-                        f.write(video_info['url'])
-                    thumbnail_url = video_info.get('thumbnail')
-                    if thumbnail_url and thumbnail_url.startswith('http'):
-                        thumbnail_file = os.path.join(METADATA_DIR, f"{query_hash}.jpg")
-                        response = requests.get(thumbnail_url)
-                        with open(thumbnail_file, 'wb') as f:
-                            f.write(response.content)
+        # Demucs runs one song at a time; the single-threaded Melodia conversions run in parallel behind it
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {}
+            for video_info in video_infos:
+                if video_info:
+                    video_title = video_info['title']
+                    video_url = video_info['url']
+                    sanitized_video_title = sanitize_filename(video_title)
+                    mp3_file = os.path.join(LIBRARY_DIR, f"{sanitized_video_title}.mp3")
+                    if not is_in_library(video_url):
+                        logger.info(f"Processing {video_title}...")
+                        extract_vocals(mp3_file, LIBRARY_DIR)
+                        future = executor.submit(convert_and_save, video_info, sanitized_video_title, logger)
+                        futures[future] = video_title
                     else:
-                        logger.warning(f"Invalid or missing thumbnail URL for {video_title}")
-                    logger.info(f"Completed processing {video_title}")
+                        logger.info(f"{video_title} is already in the library.")
                 else:
-                    logger.info(f"{video_title} is already in the library.")
-            else:
-                logger.error(f"Failed to fetch metadata for {url}")
+                    logger.error(f"Failed to fetch metadata for {url}")
+
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception():
+                    logger.error(f"Failed to convert {futures[future]}: {future.exception()}")
 
     log_file = os.path.join(LOG_DIR, f"{hashlib.md5(url.encode()).hexdigest()}.log")
     logger = setup_logger("process_logger", log_file)
@@ -72,7 +72,7 @@ def search_youtube(query):
             'preferredcodec': 'mp3',
             'preferredquality': '192',
         }],
-        'outtmpl': '/home/ubuntu/MeloDetective/data/library/%(title)s.%(ext)s',
+        'outtmpl': f'{LIBRARY_DIR}/%(title)s.%(ext)s',
     }
     
     with yt_dlp.YoutubeDL(ydl_opts) as ydl: